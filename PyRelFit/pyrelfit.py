@@ -1,10 +1,10 @@
-import glob
 import sys
 import time
 import click
 import csv
 import os
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import numpy as np
 from cyvcf2 import VCF
 from multiprocessing import Pool
 import re
@@ -12,7 +12,21 @@ import re
 GRAPHICS_OPACITY = 0.8
 GRAPHICS_POINT_SIZE = 4
 GRAPHICS_ENABLED = False
+# Created on first use in each worker and reused for every plot.
+GRAPHICS_FIGURE = None
 OUTLIERS_ENABLED = False
+OUTLIER_THRESHOLDS = (0.2, 0.4, 0.6, 0.8)
+OUTLIER_GROUPS = ("gt_2", "gt_4", "gt_6", "gt_8")
+VARIANT_BATCH_SIZE = 4096
+WRITE_BUFFER_SIZE = 1 << 20
+TEMP_COLUMN_DTYPES = {
+    "pos": np.int32,
+    "ref": "S1",
+    "alt": "S1",
+    "rf": np.float64
+}
+SITE_COLUMNS = ("pos", "ref", "alt")
+SNP_ALLELES = frozenset("ACGT")
 
 def comma_separated(ctx, param, value):
     return value.split(',')
@@ -32,10 +46,13 @@ def remove_dir_recursive(path):
     os.rmdir(path)
 
 def list_to_dict_max(lst):
-    max_dict = {}
-    for value, key in lst:
-        max_dict[key] = max(max_dict.get(key, -float('inf')), value)
-    return max_dict
+    lst = list(lst)
+    values = np.asarray([value for value, _ in lst], dtype=np.float64)
+    keys, inverse = np.unique([key for _, key in lst], return_inverse=True)
+
+    max_values = np.full(len(keys), -np.inf)
+    np.maximum.at(max_values, inverse, values)
+    return dict(zip(keys.tolist(), max_values.tolist()))
 
 def parse_generations(samples, generation_string):
     if not generation_string.startswith("/") or not generation_string.endswith("/"):
@@ -45,44 +62,116 @@ def parse_generations(samples, generation_string):
     if len(parts) % 2 != 0:
         raise ValueError("Invalid generation format: must be /<id>/<regex>/<id>/<regex>/...")
 
-    gen_sample_map = {}
-    for i in range(0, len(parts), 2):
-        gen_id = parts[i]
-        regex = re.compile(parts[i + 1])
-        matching_samples = [sample for sample in samples if regex.search(sample)]
-        gen_sample_map[gen_id] = matching_samples
+    patterns = {parts[i]: re.compile(parts[i + 1]).search for i in range(0, len(parts), 2)}
+    gen_sample_map = {gen_id: [] for gen_id in patterns}
+
+    # A sample is added to every generation whose regex it matches.
+    for sample in samples:
+        for gen_id, search in patterns.items():
+            if search(sample):
+                gen_sample_map[gen_id].append(sample)
 
     return gen_sample_map
 
 
-def compute_counts(variant):
-    total = variant.num_called * 2
-    alt_count = variant.num_het + variant.num_hom_alt * 2
+def compute_counts(gt_types):
+    """
+    Computes alt allele counts and total called alleles for a batch of variants.
+    Rows of gt_types are variants, columns are samples, coded as cyvcf2 gt_types
+    (0 = HOM_REF, 1 = HET, 2 = UNKNOWN, 3 = HOM_ALT).
+    """
+    het = (gt_types == 1).sum(axis=1)
+    hom_alt = (gt_types == 3).sum(axis=1)
+    called = (gt_types != 2).sum(axis=1)
 
-    return alt_count, total
+    return het + 2 * hom_alt, 2 * called
 
-def filter_split_unit(args):
-    vcf_path, chrom, gen, samples, temp_dir = args
-    try:
-        vcf = VCF(vcf_path, samples=samples)
+def relative_fitness(ac1, total1, ac2, total2):
+    """
+    Computes relative fitness w = f2^2 / (2*f1^2 - f1*f2^2) for arrays of allele counts.
+    Variants with no alt allele in the first generation, or a zero denominator, get w = 0.
+    """
+    n = len(ac1)
+    # Divide only where the result is used, filling the rest with the fallback values.
+    f1 = np.divide(ac1, total1, out=np.zeros(n), where=total1 != 0)
+    f2_sq = np.divide(ac2, total2, out=np.full(n, 1e-8), where=total2 != 0)
+    f2_sq *= f2_sq
 
-        with open(f"{temp_dir}/tmp.{chrom}.{gen}.csv", "a") as f:
-            for variant in vcf(chrom):
-                if not variant.is_snp: continue
-                if not variant.ALT: continue
+    denom = f1 * f1
+    denom *= 2
+    denom -= f1 * f2_sq
+    return np.divide(f2_sq, denom, out=np.zeros(n), where=(f1 != 0) & (denom != 0))
+
+def temp_column_path(temp_dir, chrom, key, column):
+    # Site columns are shared by all generation pairs and stored without a key.
+    if key is None:
+        return f"{temp_dir}/tmp.{chrom}.{column}.bin"
+    return f"{temp_dir}/tmp.{chrom}.{key}.{column}.bin"
+
+def load_column(temp_dir, chrom, key, column):
+    return np.fromfile(temp_column_path(temp_dir, chrom, key, column), dtype=TEMP_COLUMN_DTYPES[column])
+
+def write_columns(files, gen_idx, pairs, pos, ref, alt, gt_types):
+    counts = {gen: compute_counts(gt_types[:, idx]) for gen, idx in gen_idx.items()}
 
-                pos = variant.POS
-                ref = variant.REF
-                alt = variant.ALT[0]
+    columns = {(None, "pos"): pos, (None, "ref"): ref, (None, "alt"): alt}
+    for pair, gen1, gen2 in pairs:
+        columns[pair, "rf"] = relative_fitness(*counts[gen1], *counts[gen2])
 
-                alt_count, total = compute_counts(variant)
+    for (key, column), values in columns.items():
+        values.astype(TEMP_COLUMN_DTYPES[column], copy=False).tofile(files[key, column])
 
-                csv.writer(f).writerow([pos, ref, alt, alt_count, total])
+    return {pair: float(columns[pair, "rf"].max(initial=0.0)) for pair, _, _ in pairs}
+
+def filter_compute_unit(args):
+    vcf_path, chrom, gens, pairs, temp_dir = args
+    try:
+        # Parse the chromosome once for all generations, then split genotypes by sample index.
+        vcf = VCF(vcf_path, samples=list(dict.fromkeys(s for samples in gens.values() for s in samples)))
+        sample_idx = {s: i for i, s in enumerate(vcf.samples)}
+        gen_idx = {gen: np.array([sample_idx[s] for s in samples], dtype=np.intp) for gen, samples in gens.items()}
+
+        pos_buf = np.empty(VARIANT_BATCH_SIZE, dtype=TEMP_COLUMN_DTYPES["pos"])
+        ref_buf = np.empty(VARIANT_BATCH_SIZE, dtype=TEMP_COLUMN_DTYPES["ref"])
+        alt_buf = np.empty(VARIANT_BATCH_SIZE, dtype=TEMP_COLUMN_DTYPES["alt"])
+        gt_buf = np.empty((VARIANT_BATCH_SIZE, len(vcf.samples)), dtype=np.int8)
+        max_w = {pair: 0.0 for pair, _, _ in pairs}
+
+        files = {(None, c): open(temp_column_path(temp_dir, chrom, None, c), "wb") for c in SITE_COLUMNS}
+        try:
+            for pair, _, _ in pairs:
+                files[pair, "rf"] = open(temp_column_path(temp_dir, chrom, pair, "rf"), "wb")
+
+            n = 0
+            for variant in vcf(chrom):
+                # Same selection as variant.is_snp, without the extra property lookups.
+                ref, alt = variant.REF, variant.ALT
+                if len(ref) != 1 or not alt or not SNP_ALLELES.issuperset(alt): continue
+
+                pos_buf[n] = variant.POS
+                ref_buf[n] = ref
+                alt_buf[n] = alt[0]
+                gt_buf[n] = variant.gt_types
+                n += 1
+
+                if n == VARIANT_BATCH_SIZE:
+                    for pair, batch_max in write_columns(files, gen_idx, pairs, pos_buf, ref_buf, alt_buf, gt_buf).items():
+                        max_w[pair] = max(max_w[pair], batch_max)
+                    n = 0
+
+            for pair, batch_max in write_columns(files, gen_idx, pairs, pos_buf[:n], ref_buf[:n], alt_buf[:n], gt_buf[:n]).items():
+                max_w[pair] = max(max_w[pair], batch_max)
+        finally:
+            for f in files.values():
+                f.close()
+
+        return chrom, max_w
     except Exception as e:
         print(e, file=sys.stderr)
+        return None
 
 
-def filter_and_split(vcf_path, generations, temp_dir, cores, chromosomes=None):
+def filter_and_compute(vcf_path, generations, generation_pairs, temp_dir, cores, chromosomes=None):
     vcf = VCF(vcf_path, threads=cores)
 
     if chromosomes:
@@ -92,123 +181,99 @@ def filter_and_split(vcf_path, generations, temp_dir, cores, chromosomes=None):
         chromosomes = vcf.seqnames
     gens = parse_generations(vcf.samples, generations)
 
-    tasks = [(vcf_path, c, gen, gens[gen], temp_dir) for c in chromosomes for gen in gens.keys()]
+    pairs = []
+    for pair in generation_pairs:
+        gen1, gen2 = pair.split("_")
+        if gen1 not in gens or gen2 not in gens:
+            raise ValueError(f"Generation pair {pair} refers to an unknown generation id.")
+        pairs.append((pair, gen1, gen2))
+    # Only generations used by a pair need their genotypes decoded.
+    used_gens = {gen for _, gen1, gen2 in pairs for gen in (gen1, gen2)}
+    gens = {gen: samples for gen, samples in gens.items() if gen in used_gens}
+
+    # One task per chromosome, covering every generation pair.
+    tasks = [(vcf_path, c, gens, pairs, temp_dir) for c in chromosomes]
     with Pool(processes=cores) as pool:
-        pool.map(filter_split_unit, tasks, chunksize=1)
+        results = pool.map(filter_compute_unit, tasks, chunksize=1)
 
+    # Failed chromosomes are left out of both the maxima and the normalization step.
+    results = [r for r in results if r is not None]
+    # MAX should be per generation_pair
+    scale_list = list_to_dict_max((value, pair) for _, max_w in results for pair, value in max_w.items())
+    return scale_list, [chrom for chrom, _ in results]
 
-def process_pair(args):
-    chrom, pair, temp_dir, out_dir = args
-    gen1, gen2 = pair.split("_")
-    max_w = 0.0
 
-    with open(f"{temp_dir}/tmp.{chrom}.{gen1}.csv") as f1:
-        with open(f"{temp_dir}/tmp.{chrom}.{gen2}.csv") as f2:
-            with open(f"{out_dir}/{chrom}.{pair}.csv", "w") as out:
-                writer = csv.writer(out)
-                writer.writerow(["Pos", "Ref", "Alt", "RF"])
+def plot_normalized(png_filename, pos, rf):
+    global GRAPHICS_FIGURE
+    if GRAPHICS_FIGURE is None:
+        GRAPHICS_FIGURE = Figure(figsize=(16, 9))
+        GRAPHICS_FIGURE.add_subplot()
 
-                for (r1, r2) in zip(csv.reader(f1), csv.reader(f2)):
-                    pos, ref, alt = r1[:3]
-                    ac1, total1 = map(int, r1[3:])
-                    ac2, total2 = map(int, r2[3:])
+    ax = GRAPHICS_FIGURE.axes[0]
+    ax.clear()
+    ax.scatter(pos, rf, alpha=GRAPHICS_OPACITY, s=GRAPHICS_POINT_SIZE)
+    ax.set_title("Normalized Data Plot")
+    ax.set_xlabel("Position in Chr")
+    ax.set_ylabel("Relative fitness")
+    ax.set_ylim(0, 1)
+    GRAPHICS_FIGURE.savefig(png_filename)
 
-                    f1 = ac1 / total1 if total1 else 0
-                    f2 = ac2 / total2 if total2 and total2 != 0 else 1e-8
 
-                    w = (f2 ** 2) / (2 * f1 ** 2 - f1 * f2 ** 2) if f1 and f1 != 0.0 and f1 != 0 else 0
-                    max_w = max(max_w, w)
+def write_rows(writer, pos, ref, alt, rf):
+    # Convert one batch at a time so only a slice of the columns exists as Python objects.
+    for start in range(0, len(rf), VARIANT_BATCH_SIZE):
+        batch = slice(start, start + VARIANT_BATCH_SIZE)
+        writer.writerows(zip(
+            pos[batch].tolist(), ref[batch].astype("U1").tolist(), alt[batch].astype("U1").tolist(), rf[batch].tolist()
+        ))
 
-                    writer.writerow([pos, ref, alt, w])
 
-            return max_w, pair
+def normalize_file(args):
+    chrom, pair, temp_dir, out_dir, global_max = args
+    filename = f"{out_dir}/{chrom}.{pair}.csv"
+    header = ["Pos", "Ref", "Alt", "RF"]
 
+    rf = load_column(temp_dir, chrom, pair, "rf")
+    pos = load_column(temp_dir, chrom, None, "pos")
+    ref = load_column(temp_dir, chrom, None, "ref")
+    alt = load_column(temp_dir, chrom, None, "alt")
 
-def merge_and_compute(generation_pairs, cores, temp_dir, out_dir):
-    chromosomes = {f.split(".")[1] for f in glob.glob(f"{temp_dir}/tmp.*.{generation_pairs[0].split('_')[0]}.csv")}
-    tasks = [(c, p, temp_dir, out_dir) for c in chromosomes for p in generation_pairs]
+    with open(filename, "w", buffering=WRITE_BUFFER_SIZE) as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(header)
 
-    with Pool(processes=cores) as pool:
-        max_vals = pool.map(process_pair, tasks, chunksize=1)
-    # MAX should be per generation_pair
-    return list_to_dict_max(max_vals)
+        # Pairs whose maximum is 0 or 1 are written as computed.
+        if global_max == 0 or global_max == 1:
+            write_rows(writer, pos, ref, alt, rf)
+            return
 
+        rf /= global_max
+        write_rows(writer, pos, ref, alt, rf)
 
-def normalize_file(args):
-    filename, global_max = args
-    if global_max == 0 or global_max == 1: return
-
-    with open(filename) as f_in:
-        with open(f"{filename}.tmp", "w") as f_out:
-            reader = csv.reader(f_in)
-            writer = csv.writer(f_out)
-            header = next(reader)
-            writer.writerow(header)
-
-            x_vals = []
-            y_vals = []
-
-            if OUTLIERS_ENABLED:
-                outlier_groups = {
-                    "gt_8": [],
-                    "gt_6": [],
-                    "gt_4": [],
-                    "gt_2": []
-                }
-
-            for row in reader:
-                row[-1] = float(row[-1]) / global_max
-                if GRAPHICS_ENABLED:
-                    x_vals.append(float(row[0]))
-                    y_vals.append(row[-1])
-
-                if OUTLIERS_ENABLED:
-                    out_entry = row.copy()
-                    if float(row[-1]) > 0.8:
-                        outlier_groups["gt_8"].append(out_entry)
-                    elif float(row[-1]) > 0.6:
-                        outlier_groups["gt_6"].append(out_entry)
-                    elif float(row[-1]) > 0.4:
-                        outlier_groups["gt_4"].append(out_entry)
-                    elif float(row[-1]) > 0.2:
-                        outlier_groups["gt_2"].append(out_entry)
-
-                writer.writerow(row)
-
-            if GRAPHICS_ENABLED:
-                png_filename = os.path.splitext(filename)[0]
-
-                plt.figure(figsize=(16, 9))
-                plt.scatter(x_vals, y_vals, alpha=GRAPHICS_OPACITY, s=GRAPHICS_POINT_SIZE)
-                plt.title("Normalized Data Plot")
-                plt.xlabel("Position in Chr")
-                plt.ylabel("Relative fitness")
-                plt.ylim(0, 1)
-                plt.savefig(f"{png_filename}.png")
-                plt.close()
-
-        os.replace(f"{filename}.tmp", filename)
+    if GRAPHICS_ENABLED:
+        png_filename = os.path.splitext(filename)[0]
+        plot_normalized(f"{png_filename}.png", pos, rf)
 
     if OUTLIERS_ENABLED:
         base_name = os.path.basename(filename)
-        out_dir = os.path.dirname(filename)
+        # Group i holds RF in (OUTLIER_THRESHOLDS[i-1], OUTLIER_THRESHOLDS[i]], the last one RF > 0.8.
+        group_ids = np.digitize(rf, OUTLIER_THRESHOLDS, right=True)
 
-        for group, entries in outlier_groups.items():
+        for group_id, group in enumerate(OUTLIER_GROUPS, start=1):
+            idx = np.flatnonzero(group_ids == group_id)
             group_file = os.path.join(out_dir, f"{group}.{base_name}")
             with open(group_file, "w", newline="") as gf:
                 group_writer = csv.writer(gf)
                 group_writer.writerow(header)
-                group_writer.writerows(entries)
+                write_rows(group_writer, pos[idx], ref[idx], alt[idx], rf[idx])
 
 
-def normalise(scale_list, generation_pairs, cores, out_dir):
-    files = []
-
-    for pair in generation_pairs:
-        files.extend([(s,pair) for s in glob.glob(f"{out_dir}/*.{pair}.csv")])
+def normalise(scale_list, chromosomes, generation_pairs, cores, temp_dir, out_dir):
+    # Only chromosomes computed in this run, stale temp files are ignored.
+    tasks = [(c, pair, temp_dir, out_dir, scale_list.get(pair)) for c in chromosomes for pair in generation_pairs]
 
     with Pool(processes=cores) as pool:
-        pool.map(normalize_file, [(f, scale_list.get(p)) for f, p in files], chunksize=1)
+        pool.map(normalize_file, tasks, chunksize=1)
         pool.close()
 
 
@@ -236,11 +301,9 @@ def pyrelfit(input_file, generations, generation_pairs, cores, temp_dir, out_dir
 
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(out_dir, exist_ok=True)
-    filter_and_split(input_file, generations, temp_dir, cores, chromosomes)
+    scale_list, computed = filter_and_compute(input_file, generations, generation_pairs, temp_dir, cores, chromosomes)
     print("Step 1 in: ", time.time() - start_time, " seconds.")
-    scale_list = merge_and_compute(generation_pairs, cores, temp_dir, out_dir)
-    print("Step 2 in: ", time.time() - start_time, " seconds.")
-    normalise(scale_list, generation_pairs, cores, out_dir)
+    normalise(scale_list, computed, generation_pairs, cores, temp_dir, out_dir)
 
     if not keep_temp:
         print("Deleting temporary files...")